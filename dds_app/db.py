@@ -1,13 +1,21 @@
 """Database helpers for the cash flow web application."""
 from __future__ import annotations
 
+import atexit
 from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
+import re
 import sqlite3
-from typing import Any, Dict, Iterable, Iterator, List, Optional
+import threading
+from typing import Any, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
 DB_PATH = Path(__file__).resolve().parent / "dds.sqlite3"
+_DB_PATH_STR = str(DB_PATH)
+_DB_RO_URI = f"{DB_PATH.as_uri()}?mode=ro"
+
+# Версия схемы хранится в PRAGMA user_version; при изменении SCHEMA её нужно увеличить.
+SCHEMA_VERSION = 3
 
 SCHEMA = """
 PRAGMA foreign_keys = ON;
@@ -44,36 +52,192 @@ CREATE TABLE IF NOT EXISTS cashflows (
     category_id INTEGER NOT NULL REFERENCES categories(id),
     subcategory_id INTEGER NOT NULL REFERENCES subcategories(id),
     amount_cents INTEGER NOT NULL,
-    comment TEXT
+    comment TEXT,
+    -- Денормализованные названия справочников: список записей читается без JOIN.
+    status_name TEXT,
+    type_name TEXT,
+    category_name TEXT,
+    subcategory_name TEXT
 );
+
+CREATE INDEX IF NOT EXISTS idx_cashflows_status ON cashflows(status_id);
+CREATE INDEX IF NOT EXISTS idx_cashflows_type ON cashflows(type_id);
+-- Составные индексы также обслуживают проверку смены родителя (repo.check_reparent).
+-- categories(type_id) и subcategories(category_id) покрыты индексами их UNIQUE.
+CREATE INDEX IF NOT EXISTS idx_cashflows_category_type ON cashflows(category_id, type_id);
+CREATE INDEX IF NOT EXISTS idx_cashflows_subcategory_category ON cashflows(subcategory_id, category_id);
+CREATE INDEX IF NOT EXISTS idx_cashflows_recorded ON cashflows(recorded_on DESC, id DESC);
+
+CREATE TRIGGER IF NOT EXISTS trg_statuses_name AFTER UPDATE OF name ON statuses
+BEGIN
+    UPDATE cashflows SET status_name = NEW.name WHERE status_id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_types_name AFTER UPDATE OF name ON types
+BEGIN
+    UPDATE cashflows SET type_name = NEW.name WHERE type_id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_categories_name AFTER UPDATE OF name ON categories
+BEGIN
+    UPDATE cashflows SET category_name = NEW.name WHERE category_id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_subcategories_name AFTER UPDATE OF name ON subcategories
+BEGIN
+    UPDATE cashflows SET subcategory_name = NEW.name WHERE subcategory_id = NEW.id;
+END;
 """
 
+_CREATE_RE = re.compile(r"CREATE (?:TABLE|INDEX|TRIGGER) IF NOT EXISTS (\w+)")
+
+
+def _split_schema(script: str) -> List[Tuple[str, str]]:
+    """Split a DDL script into ``(object name, CREATE statement)`` pairs."""
+    statements: List[Tuple[str, str]] = []
+    buffer = ""
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        # complete_statement() учитывает BEGIN ... END, поэтому триггеры не разрываются.
+        if sqlite3.complete_statement(buffer):
+            # search(), а не match(): перед CREATE могут стоять строки комментариев.
+            match = _CREATE_RE.search(buffer)
+            if match:
+                statements.append((match.group(1), buffer.strip()))
+            buffer = ""
+    return statements
+
+
+_SCHEMA_STATEMENTS = _split_schema(SCHEMA)
+
+# Индексы прежних версий схемы, заменённые составными.
+_OBSOLETE_INDEXES = ("idx_cashflows_category", "idx_cashflows_subcategory")
+
+DENORMALIZED_NAME_COLUMNS = ("status_name", "type_name", "category_name", "subcategory_name")
+
+
+_local = threading.local()
+
 
-def get_connection() -> sqlite3.Connection:
-    """Return a SQLite connection with useful defaults."""
-    conn = sqlite3.connect(DB_PATH)
+def _connect(database: str, *, uri: bool = False) -> sqlite3.Connection:
+    # isolation_level=None отключает неявные BEGIN модуля sqlite3: транзакции
+    # открывает db_cursor(commit=True).
+    conn = sqlite3.connect(database, uri=uri, isolation_level=None, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -64000")
     return conn
 
 
+def get_connection(readonly: bool = False) -> sqlite3.Connection:
+    """Return the thread's long-lived SQLite connection, opening it on first use.
+
+    Read-only connections never take write locks, so readers do not contend
+    with the writer in WAL mode.
+    """
+    # Соединения переиспользуются: файл не открывается заново и кэш страниц сохраняется.
+    if readonly:
+        conn = getattr(_local, "ro_conn", None)
+        if conn is None:
+            conn = _local.ro_conn = _connect(_DB_RO_URI, uri=True)
+        return conn
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect(_DB_PATH_STR)
+    return conn
+
+
+def close_connection() -> None:
+    """Close the connections of the current thread, if they were opened."""
+    ro_conn = getattr(_local, "ro_conn", None)
+    if ro_conn is not None:
+        _local.ro_conn = None
+        ro_conn.close()
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        # Обновляет статистику планировщика для запросов, выполненных этим соединением.
+        conn.execute("PRAGMA optimize")
+        conn.close()
+
+
+atexit.register(close_connection)
+
+
 @contextmanager
-def db_cursor(commit: bool = False) -> Iterator[sqlite3.Cursor]:
-    conn = get_connection()
+def db_cursor(commit: bool = False, readonly: bool = False) -> Iterator[sqlite3.Cursor]:
+    # Внутри открытой transaction() все запросы, включая чтение, идут через её
+    # соединение, а BEGIN/COMMIT выполняет только внешний блок.
+    conn = getattr(_local, "conn", None)
+    nested = conn is not None and conn.in_transaction
+    if not nested:
+        conn = get_connection(readonly)
+    cur = conn.cursor()
     try:
-        cur = conn.cursor()
+        if commit and not nested:
+            # Блокировка записи берётся сразу, а не при первом изменении, чтобы
+            # не получить SQLITE_BUSY посреди транзакции.
+            cur.execute("BEGIN IMMEDIATE")
         yield cur
-        if commit:
-            conn.commit()
+        if commit and not nested:
+            cur.execute("COMMIT")
+    except Exception:
+        if not nested and conn.in_transaction:
+            cur.execute("ROLLBACK")
+        raise
     finally:
-        conn.close()
+        cur.close()
+
+
+@contextmanager
+def transaction() -> Iterator[None]:
+    """Run several repository calls in one write transaction with a single commit."""
+    with db_cursor(commit=True):
+        yield
 
 
 def init_db() -> None:
     """Create database schema if it does not exist."""
+    with db_cursor() as cur:
+        # Режим WAL хранится в самом файле базы, поэтому включается при инициализации.
+        cur.execute("PRAGMA journal_mode = WAL")
+    migrate_cashflow_names()
     with db_cursor(commit=True) as cur:
-        cur.executescript(SCHEMA)
+        # Выполняются только CREATE для отсутствующих объектов, без повторного разбора всей схемы.
+        cur.execute("SELECT name FROM sqlite_master")
+        existing = {row["name"] for row in cur.fetchall()}
+        for name, statement in _SCHEMA_STATEMENTS:
+            if name not in existing:
+                cur.execute(statement)
+        for name in _OBSOLETE_INDEXES:
+            if name in existing:
+                cur.execute(f"DROP INDEX {name}")
     ensure_initial_data()
+    with db_cursor(commit=True) as cur:
+        # Статистика sqlite_stat1 помогает планировщику выбирать индексы.
+        cur.execute("ANALYZE")
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def migrate_cashflow_names() -> None:
+    """Add and backfill denormalized reference names in databases created before them."""
+    with db_cursor(commit=True) as cur:
+        cur.execute("PRAGMA table_info(cashflows)")
+        columns = {row["name"] for row in cur.fetchall()}
+        if not columns or set(DENORMALIZED_NAME_COLUMNS) <= columns:
+            return
+        for column in DENORMALIZED_NAME_COLUMNS:
+            if column not in columns:
+                cur.execute(f"ALTER TABLE cashflows ADD COLUMN {column} TEXT")
+        cur.execute(
+            "UPDATE cashflows SET "
+            "status_name = (SELECT name FROM statuses WHERE id = cashflows.status_id), "
+            "type_name = (SELECT name FROM types WHERE id = cashflows.type_id), "
+            "category_name = (SELECT name FROM categories WHERE id = cashflows.category_id), "
+            "subcategory_name = (SELECT name FROM subcategories WHERE id = cashflows.subcategory_id)"
+        )
 
 
 DEFAULT_STATUSES = [
@@ -97,90 +261,148 @@ DEFAULT_CATEGORIES = [
 def ensure_initial_data() -> None:
     """Seed the reference tables with basic values."""
     with db_cursor(commit=True) as cur:
-        cur.execute("SELECT COUNT(*) FROM statuses")
-        if cur.fetchone()[0] == 0:
+        # Все проверки заполненности выполняются одним запросом, а вставки идут в одной транзакции.
+        cur.execute(
+            "SELECT EXISTS(SELECT 1 FROM statuses), EXISTS(SELECT 1 FROM types), "
+            "EXISTS(SELECT 1 FROM categories)"
+        )
+        has_statuses, has_types, has_categories = cur.fetchone()
+
+        if not has_statuses:
             cur.executemany("INSERT INTO statuses(name) VALUES (?)",
                             [(name,) for name in DEFAULT_STATUSES])
 
-        cur.execute("SELECT COUNT(*) FROM types")
-        if cur.fetchone()[0] == 0:
+        if not has_types:
             cur.executemany("INSERT INTO types(name) VALUES (?)",
                             [(name,) for name in DEFAULT_TYPES])
 
-        cur.execute("SELECT COUNT(*) FROM categories")
-        if cur.fetchone()[0] == 0:
-            for category_name, type_name, subcats in DEFAULT_CATEGORIES:
-                cur.execute("SELECT id FROM types WHERE name = ?", (type_name,))
-                row = cur.fetchone()
-                if not row:
-                    continue
-                type_id = row[0]
-                cur.execute(
-                    "INSERT INTO categories(name, type_id) VALUES (?, ?)",
-                    (category_name, type_id),
-                )
-                category_id = cur.lastrowid
-                cur.executemany(
-                    "INSERT INTO subcategories(name, category_id) VALUES (?, ?)",
-                    [(sub, category_id) for sub in subcats],
-                )
-
-
-def fetchall(sql: str, params: Iterable[Any] = ()) -> List[Dict[str, Any]]:
-    with db_cursor() as cur:
-        cur.execute(sql, tuple(params))
-        rows = cur.fetchall()
-    return [dict(row) for row in rows]
+        if not has_categories:
+            cur.execute("SELECT name, id FROM types")
+            type_ids = dict(cur.fetchall())
+            seeds = [
+                (category_name, type_ids[type_name], subcats)
+                for category_name, type_name, subcats in DEFAULT_CATEGORIES
+                if type_name in type_ids
+            ]
+            cur.executemany(
+                "INSERT INTO categories(name, type_id) VALUES (?, ?)",
+                [(category_name, type_id) for category_name, type_id, _ in seeds],
+            )
+            cur.execute("SELECT name, type_id, id FROM categories")
+            category_ids = {(row[0], row[1]): row[2] for row in cur.fetchall()}
+            cur.executemany(
+                "INSERT INTO subcategories(name, category_id) VALUES (?, ?)",
+                [
+                    (sub, category_ids[(category_name, type_id)])
+                    for category_name, type_id, subcats in seeds
+                    for sub in subcats
+                ],
+            )
 
 
-def fetchone(sql: str, params: Iterable[Any] = ()) -> Optional[Dict[str, Any]]:
-    with db_cursor() as cur:
-        cur.execute(sql, tuple(params))
-        row = cur.fetchone()
-    return dict(row) if row else None
+Params = Union[Iterable[Any], Mapping[str, Any]]
+
+
+def _bind(params: Params) -> Any:
+    # Кортежи и словари sqlite3 принимает как есть, копируем только прочие итерируемые.
+    return params if isinstance(params, (tuple, dict)) else tuple(params)
 
 
-def execute(sql: str, params: Iterable[Any] = ()) -> int:
+def fetchall(sql: str, params: Params = ()) -> List[sqlite3.Row]:
+    """Return rows as sqlite3.Row; callers that need a mutable dict call dict(row)."""
+    with db_cursor(readonly=True) as cur:
+        cur.execute(sql, _bind(params))
+        return cur.fetchall()
+
+
+def fetchone(sql: str, params: Params = ()) -> Optional[sqlite3.Row]:
+    with db_cursor(readonly=True) as cur:
+        cur.execute(sql, _bind(params))
+        return cur.fetchone()
+
+
+def execute(sql: str, params: Params = ()) -> int:
     with db_cursor(commit=True) as cur:
-        cur.execute(sql, tuple(params))
+        cur.execute(sql, _bind(params))
         return cur.lastrowid
 
 
-def executemany(sql: str, params_seq: Iterable[Iterable[Any]]) -> None:
+def execute_returning(sql: str, params: Params = ()) -> Optional[sqlite3.Row]:
+    """Run a write with a RETURNING clause and return its first row, if any."""
+    with db_cursor(commit=True) as cur:
+        cur.execute(sql, _bind(params))
+        # Строки RETURNING выбираются до COMMIT, пока выражение ещё активно.
+        rows = cur.fetchall()
+    return rows[0] if rows else None
+
+
+def executemany(sql: str, params_seq: Iterable[Params]) -> None:
     with db_cursor(commit=True) as cur:
-        cur.executemany(sql, [tuple(params) for params in params_seq])
+        cur.executemany(sql, (_bind(params) for params in params_seq))
 
 
-@dataclass
+@dataclass(eq=False)
 class ReferenceLists:
-    statuses: List[Dict[str, Any]]
-    types: List[Dict[str, Any]]
-    categories: List[Dict[str, Any]]
-    subcategories: List[Dict[str, Any]]
+    statuses: List[sqlite3.Row]
+    types: List[sqlite3.Row]
+    categories: List[sqlite3.Row]
+    subcategories: List[sqlite3.Row]
+
+
+# Все четыре справочника читаются одним запросом: kind задаёт список (0 — статусы,
+# 1 — типы, 2 — категории, 3 — подкатегории), sort1..sort3 — порядок внутри него.
+# Категории и подкатегории идут подряд по родителю (имена типов уникальны, у
+# одноимённых категорий порядок уточняет category_id), что позволяет группировать их groupby.
+# Неприменимые к списку столбцы равны NULL.
+_REFERENCE_LISTS_SQL = (
+    "SELECT kind, id, name, type_id, type_name, category_id, category_name FROM ("
+    "SELECT 0 AS kind, id, name, NULL AS type_id, NULL AS type_name, NULL AS category_id, "
+    "NULL AS category_name, name AS sort1, NULL AS sort2, NULL AS sort3 FROM statuses "
+    "UNION ALL "
+    "SELECT 1, id, name, NULL, NULL, NULL, NULL, name, NULL, NULL FROM types "
+    "UNION ALL "
+    "SELECT 2, categories.id, categories.name, type_id, types.name, NULL, NULL, types.name, categories.name, NULL "
+    "FROM categories JOIN types ON categories.type_id = types.id "
+    "UNION ALL "
+    "SELECT 3, subcategories.id, subcategories.name, categories.type_id, NULL, category_id, categories.name, "
+    "categories.name, subcategories.category_id, subcategories.name "
+    "FROM subcategories JOIN categories ON subcategories.category_id = categories.id"
+    ") ORDER BY kind, sort1, sort2, sort3"
+)
 
 
 def load_reference_lists() -> ReferenceLists:
-    statuses = fetchall("SELECT id, name FROM statuses ORDER BY name")
-    types = fetchall("SELECT id, name FROM types ORDER BY name")
-    categories = fetchall(
-        "SELECT categories.id, categories.name, type_id, types.name AS type_name "
-        "FROM categories JOIN types ON categories.type_id = types.id "
-        "ORDER BY types.name, categories.name"
-    )
-    subcategories = fetchall(
-        "SELECT subcategories.id, subcategories.name, category_id, categories.name AS category_name, categories.type_id "
-        "FROM subcategories JOIN categories ON subcategories.category_id = categories.id "
-        "ORDER BY categories.name, subcategories.name"
-    )
+    lists: Tuple[List[sqlite3.Row], ...] = ([], [], [], [])
+    for row in fetchall(_REFERENCE_LISTS_SQL):
+        lists[row["kind"]].append(row)
+    statuses, types, categories, subcategories = lists
     return ReferenceLists(statuses=statuses, types=types, categories=categories, subcategories=subcategories)
 
 
+# Проверка схемы выполняется один раз на процесс: повторные вызовы (импорт server,
+# затем runserver) сводятся к чтению флага.
+_INITIALIZED = False
+_INIT_LOCK = threading.Lock()
+
+
 def ensure_database() -> None:
-    """Create the SQLite database on first run."""
-    if not DB_PATH.exists():
-        init_db()
-    else:
-        # Обеспечиваем применение обновлений схемы при изменении кода.
-        with db_cursor(commit=True) as cur:
-            cur.executescript(SCHEMA)
-        ensure_initial_data()
+    """Create the SQLite database on first run or upgrade an outdated schema."""
+    global _INITIALIZED
+    if _INITIALIZED:
+        return
+    with _INIT_LOCK:
+        if _INITIALIZED:
+            return
+        if DB_PATH.exists():
+            with db_cursor() as cur:
+                cur.execute("PRAGMA user_version")
+                current_version = cur.fetchone()[0]
+                if current_version >= SCHEMA_VERSION:
+                    # init_db не запускается, а файл мог быть заменён копией в режиме
+                    # журнала отката; для базы уже в WAL команда ничего не меняет.
+                    cur.execute("PRAGMA journal_mode = WAL")
+        else:
+            current_version = 0
+        if current_version < SCHEMA_VERSION:
+            init_db()
+        _INITIALIZED = True
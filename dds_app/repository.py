@@ -1,53 +1,53 @@
 """High level database queries for the cash flow application."""
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+from functools import lru_cache
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 from . import db
 
 
-def list_cashflows(filters: Dict[str, Any]) -> List[Dict[str, Any]]:
-    conditions = []
-    params: List[Any] = []
-
-    if filters.get("date_from"):
-        conditions.append("recorded_on >= ?")
-        params.append(filters["date_from"])
-    if filters.get("date_to"):
-        conditions.append("recorded_on <= ?")
-        params.append(filters["date_to"])
-    if filters.get("status_id"):
-        conditions.append("status_id = ?")
-        params.append(filters["status_id"])
-    if filters.get("type_id"):
-        conditions.append("type_id = ?")
-        params.append(filters["type_id"])
-    if filters.get("category_id"):
-        conditions.append("category_id = ?")
-        params.append(filters["category_id"])
-    if filters.get("subcategory_id"):
-        conditions.append("subcategory_id = ?")
-        params.append(filters["subcategory_id"])
-
-    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
-
-    sql = (
-        "SELECT cashflows.id, recorded_on, amount_cents, comment, "
-        "statuses.name AS status_name, types.name AS type_name, "
-        "categories.name AS category_name, subcategories.name AS subcategory_name, "
-        "cashflows.status_id, cashflows.type_id, cashflows.category_id, cashflows.subcategory_id "
+# Условие для каждого фильтра списка записей; порядок задаёт номер бита в маске.
+_LIST_FILTERS = (
+    ("date_from", "recorded_on >= :date_from"),
+    ("date_to", "recorded_on <= :date_to"),
+    ("status_id", "status_id = :status_id"),
+    ("type_id", "type_id = :type_id"),
+    ("category_id", "category_id = :category_id"),
+    ("subcategory_id", "subcategory_id = :subcategory_id"),
+)
+
+
+@lru_cache(maxsize=2 ** len(_LIST_FILTERS))
+def _build_list_sql(mask: int) -> str:
+    # Для каждого набора фильтров строится ровно один текст запроса, поэтому sqlite3
+    # находит его в кэше выражений, а планировщик может использовать индексы.
+    # Названия справочников хранятся в самой таблице cashflows, поэтому JOIN не нужен.
+    conditions = [condition for bit, (_, condition) in enumerate(_LIST_FILTERS) if mask & (1 << bit)]
+    where_clause = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    return (
+        "SELECT id, recorded_on, amount_cents, comment, "
+        "status_name, type_name, category_name, subcategory_name, "
+        "status_id, type_id, category_id, subcategory_id "
         "FROM cashflows "
-        "JOIN statuses ON cashflows.status_id = statuses.id "
-        "JOIN types ON cashflows.type_id = types.id "
-        "JOIN categories ON cashflows.category_id = categories.id "
-        "JOIN subcategories ON cashflows.subcategory_id = subcategories.id "
-        f"{where_clause} "
-        "ORDER BY recorded_on DESC, cashflows.id DESC"
+        f"{where_clause}"
+        "ORDER BY recorded_on DESC, id DESC"
     )
-    return db.fetchall(sql, params)
 
 
-def get_cashflow(entry_id: int) -> Optional[Dict[str, Any]]:
+def list_cashflows(filters: Dict[str, Any]) -> List[sqlite3.Row]:
+    mask = 0
+    params: Dict[str, Any] = {}
+    for bit, (key, _) in enumerate(_LIST_FILTERS):
+        value = filters.get(key)
+        if value:
+            mask |= 1 << bit
+            params[key] = value
+    return db.fetchall(_build_list_sql(mask), params)
+
+
+def get_cashflow(entry_id: int) -> Optional[sqlite3.Row]:
     sql = (
         "SELECT id, recorded_on, status_id, type_id, category_id, subcategory_id, "
         "amount_cents, comment FROM cashflows WHERE id = ?"
@@ -55,39 +55,54 @@ def get_cashflow(entry_id: int) -> Optional[Dict[str, Any]]:
     return db.fetchone(sql, (entry_id,))
 
 
+# Названия справочников подставляются подзапросами в том же выражении.
+_NAME_SUBQUERIES = (
+    "(SELECT name FROM statuses WHERE id = :status_id), "
+    "(SELECT name FROM types WHERE id = :type_id), "
+    "(SELECT name FROM categories WHERE id = :category_id), "
+    "(SELECT name FROM subcategories WHERE id = :subcategory_id)"
+)
+
+
+def _cashflow_params(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "recorded_on": payload["recorded_on"],
+        "status_id": payload["status_id"],
+        "type_id": payload["type_id"],
+        "category_id": payload["category_id"],
+        "subcategory_id": payload["subcategory_id"],
+        "amount_cents": payload["amount_cents"],
+        "comment": payload.get("comment"),
+    }
+
+
+_INSERT_CASHFLOW_SQL = (
+    "INSERT INTO cashflows(recorded_on, status_id, type_id, category_id, subcategory_id, amount_cents, comment, "
+    "status_name, type_name, category_name, subcategory_name) "
+    "VALUES (:recorded_on, :status_id, :type_id, :category_id, :subcategory_id, :amount_cents, :comment, "
+    f"{_NAME_SUBQUERIES})"
+)
+
+
 def create_cashflow(payload: Dict[str, Any]) -> int:
-    sql = (
-        "INSERT INTO cashflows(recorded_on, status_id, type_id, category_id, subcategory_id, amount_cents, comment) "
-        "VALUES (?, ?, ?, ?, ?, ?, ?)"
-    )
-    params = (
-        payload["recorded_on"],
-        payload["status_id"],
-        payload["type_id"],
-        payload["category_id"],
-        payload["subcategory_id"],
-        payload["amount_cents"],
-        payload.get("comment"),
-    )
-    return db.execute(sql, params)
+    return db.execute(_INSERT_CASHFLOW_SQL, _cashflow_params(payload))
+
+
+def create_cashflows_bulk(payloads: Iterable[Dict[str, Any]]) -> None:
+    """Insert many records in one transaction, e.g. when importing a statement."""
+    with db.db_cursor(commit=True) as cur:
+        cur.executemany(_INSERT_CASHFLOW_SQL, (_cashflow_params(payload) for payload in payloads))
 
 
 def update_cashflow(entry_id: int, payload: Dict[str, Any]) -> None:
     sql = (
-        "UPDATE cashflows SET recorded_on = ?, status_id = ?, type_id = ?, category_id = ?, "
-        "subcategory_id = ?, amount_cents = ?, comment = ? WHERE id = ?"
-    )
-    params = (
-        payload["recorded_on"],
-        payload["status_id"],
-        payload["type_id"],
-        payload["category_id"],
-        payload["subcategory_id"],
-        payload["amount_cents"],
-        payload.get("comment"),
-        entry_id,
+        "UPDATE cashflows SET recorded_on = :recorded_on, status_id = :status_id, type_id = :type_id, "
+        "category_id = :category_id, subcategory_id = :subcategory_id, amount_cents = :amount_cents, "
+        "comment = :comment, "
+        f"(status_name, type_name, category_name, subcategory_name) = ({_NAME_SUBQUERIES}) "
+        "WHERE id = :entry_id"
     )
-    db.execute(sql, params)
+    db.execute(sql, {**_cashflow_params(payload), "entry_id": entry_id})
 
 
 def delete_cashflow(entry_id: int) -> None:
@@ -98,8 +113,9 @@ def create_status(name: str) -> int:
     return db.execute("INSERT INTO statuses(name) VALUES (?)", (name,))
 
 
-def update_status(status_id: int, name: str) -> None:
-    db.execute("UPDATE statuses SET name = ? WHERE id = ?", (name, status_id))
+def update_status(status_id: int, name: str) -> Optional[int]:
+    row = db.execute_returning("UPDATE statuses SET name = ? WHERE id = ? RETURNING id", (name, status_id))
+    return row["id"] if row else None
 
 
 def delete_status(status_id: int) -> None:
@@ -110,8 +126,9 @@ def create_type(name: str) -> int:
     return db.execute("INSERT INTO types(name) VALUES (?)", (name,))
 
 
-def update_type(type_id: int, name: str) -> None:
-    db.execute("UPDATE types SET name = ? WHERE id = ?", (name, type_id))
+def update_type(type_id: int, name: str) -> Optional[int]:
+    row = db.execute_returning("UPDATE types SET name = ? WHERE id = ? RETURNING id", (name, type_id))
+    return row["id"] if row else None
 
 
 def delete_type(type_id: int) -> None:
@@ -125,11 +142,12 @@ def create_category(name: str, type_id: int) -> int:
     )
 
 
-def update_category(category_id: int, name: str, type_id: int) -> None:
-    db.execute(
-        "UPDATE categories SET name = ?, type_id = ? WHERE id = ?",
+def update_category(category_id: int, name: str, type_id: int) -> Optional[int]:
+    row = db.execute_returning(
+        "UPDATE categories SET name = ?, type_id = ? WHERE id = ? RETURNING id",
         (name, type_id, category_id),
     )
+    return row["id"] if row else None
 
 
 def delete_category(category_id: int) -> None:
@@ -143,33 +161,34 @@ def create_subcategory(name: str, category_id: int) -> int:
     )
 
 
-def update_subcategory(subcategory_id: int, name: str, category_id: int) -> None:
-    db.execute(
-        "UPDATE subcategories SET name = ?, category_id = ? WHERE id = ?",
+def update_subcategory(subcategory_id: int, name: str, category_id: int) -> Optional[int]:
+    row = db.execute_returning(
+        "UPDATE subcategories SET name = ?, category_id = ? WHERE id = ? RETURNING id",
         (name, category_id, subcategory_id),
     )
+    return row["id"] if row else None
 
 
 def delete_subcategory(subcategory_id: int) -> None:
     db.execute("DELETE FROM subcategories WHERE id = ?", (subcategory_id,))
 
 
-def get_status(status_id: int) -> Optional[Dict[str, Any]]:
+def get_status(status_id: int) -> Optional[sqlite3.Row]:
     return db.fetchone("SELECT id, name FROM statuses WHERE id = ?", (status_id,))
 
 
-def get_type(type_id: int) -> Optional[Dict[str, Any]]:
+def get_type(type_id: int) -> Optional[sqlite3.Row]:
     return db.fetchone("SELECT id, name FROM types WHERE id = ?", (type_id,))
 
 
-def get_category(category_id: int) -> Optional[Dict[str, Any]]:
+def get_category(category_id: int) -> Optional[sqlite3.Row]:
     return db.fetchone(
         "SELECT id, name, type_id FROM categories WHERE id = ?",
         (category_id,),
     )
 
 
-def get_subcategory(subcategory_id: int) -> Optional[Dict[str, Any]]:
+def get_subcategory(subcategory_id: int) -> Optional[sqlite3.Row]:
     return db.fetchone(
         "SELECT subcategories.id, subcategories.name, category_id, categories.type_id "
         "FROM subcategories JOIN categories ON subcategories.category_id = categories.id "
@@ -178,7 +197,27 @@ def get_subcategory(subcategory_id: int) -> Optional[Dict[str, Any]]:
     )
 
 
-def count_dependencies(table: str, column: str, value: int) -> int:
-    query = f"SELECT COUNT(*) AS cnt FROM {table} WHERE {column} = ?"
-    row = db.fetchone(query, (value,))
-    return int(row["cnt"]) if row else 0
+def check_reparent(parent_table: str, entity_column: str, parent_column: str, entity_id: int, parent_id: int) -> Tuple[bool, bool]:
+    """Return whether the new parent exists and whether cash flow records block moving the entity to it."""
+    # Записи ДДС хранят и элемент, и его родителя, поэтому запись со старым родителем
+    # находится только при реальной смене родителя.
+    row = db.fetchone(
+        f"SELECT EXISTS(SELECT 1 FROM {parent_table} WHERE id = :parent_id), "
+        f"EXISTS(SELECT 1 FROM cashflows WHERE {entity_column} = :entity_id AND {parent_column} != :parent_id)",
+        {"parent_id": parent_id, "entity_id": entity_id},
+    )
+    return bool(row[0]), bool(row[1])  # type: ignore[index]
+
+
+@lru_cache(maxsize=None)
+def _build_dependencies_sql(links: Tuple[Tuple[str, str], ...]) -> str:
+    # EXISTS останавливается на первой найденной строке.
+    checks = ", ".join(f"EXISTS(SELECT 1 FROM {table} WHERE {column} = ?)" for table, column in links)
+    return f"SELECT {checks}"
+
+
+def has_dependencies_multi(specs: Sequence[Tuple[str, str, int]]) -> bool:
+    """Return True if any of the (table, column, value) links has a row, using one query."""
+    sql = _build_dependencies_sql(tuple((table, column) for table, column, _ in specs))
+    row = db.fetchone(sql, tuple(value for _, _, value in specs))
+    return row is not None and any(row)
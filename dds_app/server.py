@@ -2,20 +2,36 @@
 from __future__ import annotations
 
 import json
-from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-import html
 import re
+from dataclasses import dataclass
 from datetime import date
+from functools import lru_cache, partial
+from itertools import groupby
+from operator import itemgetter
 import sqlite3
-from typing import Any, Callable, Dict, List, Optional, Tuple
-from urllib.parse import parse_qs, urlencode
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import parse_qsl, urlencode
 
 from . import db
 from . import repository as repo
 
 db.ensure_database()
 
-Response = Tuple[str, List[Tuple[str, str]], bytes]
+# Тело ответа — список фрагментов bytes: WSGI-сервер пишет их по очереди без склейки.
+Response = Tuple[str, Sequence[Tuple[str, str]], Sequence[bytes]]
+
+# Общие заголовки HTML-ответов. Кортеж неизменяем, а application передаёт серверу
+# его копию: wsgiref дописывает заголовки (например, Content-Length) в полученный список.
+HTML_HEADERS: Tuple[Tuple[str, str], ...] = (("Content-Type", "text/html; charset=utf-8"),)
+
+
+def _first_values(query_string: str) -> Dict[str, str]:
+    # parse_qsl не строит списки значений; при повторе ключа берётся первое значение.
+    values: Dict[str, str] = {}
+    for key, value in parse_qsl(query_string):
+        if key not in values:
+            values[key] = value
+    return values
 
 
 class Request:
@@ -25,9 +41,15 @@ class Request:
         self.environ = environ
         self.method = environ.get("REQUEST_METHOD", "GET").upper()
         self.path = environ.get("PATH_INFO", "")
-        self.query = parse_qs(environ.get("QUERY_STRING", ""))
+        self._get: Optional[Dict[str, str]] = None
         self._body: Optional[Dict[str, Any]] = None
 
+    @property
+    def GET(self) -> Dict[str, str]:
+        if self._get is None:
+            self._get = _first_values(self.environ.get("QUERY_STRING", ""))
+        return self._get
+
     @property
     def POST(self) -> Dict[str, Any]:
         if self._body is None:
@@ -38,8 +60,7 @@ class Request:
             body_bytes = self.environ.get("wsgi.input").read(length) if length else b""
             content_type = self.environ.get("CONTENT_TYPE", "")
             if "application/x-www-form-urlencoded" in content_type:
-                data = parse_qs(body_bytes.decode("utf-8"))
-                self._body = {key: values[0] if values else "" for key, values in data.items()}
+                self._body = _first_values(body_bytes.decode("utf-8"))
             else:
                 self._body = {}
         return self._body
@@ -47,24 +68,79 @@ class Request:
     def form_value(self, key: str, default: str = "") -> str:
         if self.method == "POST":
             return self.POST.get(key, default)
-        return self.query.get(key, [default])[0]
+        return self.GET.get(key, default)
 
 
-class Router:
-    def __init__(self):
-        self._routes: List[Tuple[str, re.Pattern[str], Callable[[Request, Dict[str, str]], Response]]] = []
+Handler = Callable[[Request, Dict[str, Any]], Response]
 
-    def add(self, method: str, pattern: str, handler: Callable[[Request, Dict[str, str]], Response]) -> None:
-        self._routes.append((method.upper(), re.compile(pattern), handler))
+_REGEX_METACHARS = frozenset(".^$*+?{}[]\\|()")
+# Сегмент пути вида (?P<entry_id>\d+) — целочисленный параметр маршрута.
+_INT_SEGMENT = re.compile(r"\(\?P<(\w+)>\\d\+\)")
 
-    def resolve(self, method: str, path: str) -> Tuple[Callable[[Request, Dict[str, str]], Response], Dict[str, str]]:
-        for registered_method, regex, handler in self._routes:
-            if registered_method != method.upper():
+
+class _RouteNode:
+    """Trie node for one path segment."""
+
+    __slots__ = ("children", "param", "handlers")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _RouteNode] = {}
+        self.param: Optional[Tuple[str, _RouteNode]] = None
+        self.handlers: Dict[str, Handler] = {}
+
+
+class Router:
+    def __init__(self):
+        # Маршруты без регулярных выражений ищутся по словарю, маршруты из литералов и
+        # числовых параметров — по дереву сегментов.
+        self._static: Dict[Tuple[str, str], Handler] = {}
+        self._trie = _RouteNode()
+
+    def add(self, method: str, pattern: str, handler: Handler) -> None:
+        method = method.upper()
+        if _REGEX_METACHARS.isdisjoint(pattern):
+            self._static[(method, pattern)] = handler
+            return
+        segments = pattern.split("/")
+        if not all(_REGEX_METACHARS.isdisjoint(segment) or _INT_SEGMENT.fullmatch(segment) for segment in segments):
+            # Поддерживаются только литеральные сегменты и числовые параметры (?P<name>\d+).
+            raise ValueError(f"Unsupported route pattern {pattern}")
+        node = self._trie
+        for segment in segments:
+            param = _INT_SEGMENT.fullmatch(segment)
+            if param is None:
+                node = node.children.setdefault(segment, _RouteNode())
                 continue
-            match = regex.fullmatch(path)
-            if match:
-                return handler, match.groupdict()
-        raise KeyError("Route not found")
+            if node.param is None:
+                node.param = (param.group(1), _RouteNode())
+            elif node.param[0] != param.group(1):
+                raise ValueError(f"Conflicting parameter names in route {pattern}")
+            node = node.param[1]
+        node.handlers[method] = handler
+
+    def _walk(self, method: str, path: str) -> Optional[Tuple[Handler, Dict[str, Any]]]:
+        node = self._trie
+        params: Dict[str, Any] = {}
+        for segment in path.split("/"):
+            child = node.children.get(segment)
+            if child is None:
+                # isdecimal() принимает ровно те строки, что и \d+ в шаблоне.
+                if node.param is None or not segment.isdecimal():
+                    return None
+                name, child = node.param
+                params[name] = int(segment)
+            node = child
+        handler = node.handlers.get(method)
+        return (handler, params) if handler is not None else None
+
+    def resolve(self, method: str, path: str) -> Tuple[Optional[Handler], Optional[Dict[str, Any]]]:
+        """Return the handler and its parameters, or (None, None) when no route matches."""
+        method = method.upper()
+        handler = self._static.get((method, path))
+        if handler is not None:
+            return handler, {}
+        found = self._walk(method, path)
+        return found if found is not None else (None, None)
 
 
 router = Router()
@@ -120,17 +196,38 @@ HTML_FOOTER = """
 """
 
 
-def render_page(title: str, body: str, *, messages: Optional[List[Tuple[str, str]]] = None, active: str = "home") -> bytes:
-    messages_html = ""
-    for level, text in messages or []:
-        messages_html += f'<div class="message {level}">{html.escape(text)}</div>'
-    html_doc = HTML_HEADER.format(
-        title=html.escape(title),
+def _split_header(active: str) -> Tuple[bytes, bytes]:
+    header = HTML_HEADER.format(
+        title="{title}",
         home_active="class=\"active\"" if active == "home" else "",
         create_active="class=\"active\"" if active == "create" else "",
         reference_active="class=\"active\"" if active == "reference" else "",
-    ) + messages_html + body + HTML_FOOTER
-    return html_doc.encode("utf-8")
+    )
+    prefix, suffix = header.split("{title}")
+    return prefix.encode("utf-8"), suffix.encode("utf-8")
+
+
+# Шапка заранее отформатирована и закодирована для каждой вкладки; при запросе
+# подставляется только заголовок страницы.
+_HEADER_BY_ACTIVE = {active: _split_header(active) for active in ("home", "create", "reference")}
+HTML_FOOTER_BYTES = HTML_FOOTER.encode("utf-8")
+
+
+@lru_cache(maxsize=64)
+def _render_shell(title: str, messages: Tuple[Tuple[str, str], ...], active: str) -> bytes:
+    """Render and encode everything before the page body for a title and message set."""
+    prefix, suffix = _HEADER_BY_ACTIVE[active]
+    messages_html = "".join(
+        '<div class="message %s">%s</div>' % (level, esc(text)) for level, text in messages
+    )
+    return prefix + esc(title).encode("utf-8") + suffix + messages_html.encode("utf-8")
+
+
+def render_page(title: str, body: Union[str, bytes], *, messages: Optional[List[Tuple[str, str]]] = None, active: str = "home") -> List[bytes]:
+    # Повторяющиеся заголовки и сообщения (тексты ошибок и уведомлений) берутся из кэша.
+    shell = _render_shell(title, tuple(messages) if messages else (), active)
+    # Закэшированные тела страниц приходят уже закодированными.
+    return [shell, body if isinstance(body, bytes) else body.encode("utf-8"), HTML_FOOTER_BYTES]
 
 
 def redirect(location: str) -> Response:
@@ -138,115 +235,250 @@ def redirect(location: str) -> Response:
         ("Location", location),
         ("Content-Type", "text/plain; charset=utf-8"),
     ]
-    return "302 Found", headers, b""
+    return "302 Found", headers, []
 
 
 # ----- Вспомогательные функции -----
 
 
 def parse_int(value: str) -> Optional[int]:
-    try:
-        return int(value)
-    except (TypeError, ValueError):
+    # Проверка символов дешевле исключения, а пустые значения из <select> приходят часто.
+    if not value:
         return None
+    digits = value[1:] if value[0] in "+-" else value
+    return int(value) if digits.isdecimal() else None
+
+
+_DATE_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+
+def is_valid_date(value: str) -> bool:
+    if not _DATE_RE.fullmatch(value):
+        return False
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+
+_AMOUNT_RE = re.compile(r"([+-]?)([0-9]*)(?:\.([0-9]*))?")
 
 
 def parse_amount(value: str) -> Optional[int]:
     value = (value or "").strip().replace(" ", "")
     if not value:
         return None
-    value = value.replace(",", ".")
-    try:
-        dec_value = Decimal(value)
-    except InvalidOperation:
+    match = _AMOUNT_RE.fullmatch(value.replace(",", "."))
+    if not match:
+        return None
+    sign, whole, frac = match.groups()
+    frac = frac or ""
+    if not whole and not frac:
         return None
-    dec_value = dec_value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    cents = int(dec_value * 100)
-    return cents
+    # Округление до копеек по правилу ROUND_HALF_UP в целых числах, без Decimal.
+    cents = int(whole or "0") * 100 + int((frac + "00")[:2])
+    if len(frac) > 2 and frac[2] >= "5":
+        cents += 1
+    return -cents if sign == "-" else cents
 
 
 def format_amount(cents: int) -> str:
-    return f"{cents / 100:,.2f}".replace(",", " ")
+    # Целочисленное деление вместо float: без ошибок округления на больших суммах.
+    sign = "-" if cents < 0 else ""
+    whole, frac = divmod(abs(cents), 100)
+    groups = []
+    while whole >= 1000:
+        whole, rest = divmod(whole, 1000)
+        groups.append(f"{rest:03d}")
+    groups.append(str(whole))
+    return f"{sign}{' '.join(reversed(groups))}.{frac:02d}"
+
+
+_NEEDS_ESCAPE = re.compile(r"[&<>\"']")
+# Та же замена, что и в html.escape(quote=True), но за один проход translate().
+_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
+def esc(value: Any) -> str:
+    """Escape HTML like html.escape(), returning the string itself when nothing needs escaping."""
+    text = value if isinstance(value, str) else str(value)
+    return text.translate(_ESCAPE_TABLE) if _NEEDS_ESCAPE.search(text) else text
+
+
+class RowEncoder(json.JSONEncoder):
+    """JSON encoder that serializes sqlite3.Row objects as dictionaries."""
+
+    def default(self, o: Any) -> Any:
+        if isinstance(o, sqlite3.Row):
+            return dict(o)
+        return super().default(o)
+
+
+# ----- Кэш справочников -----
+
+# Справочники меняются только через обработчики /reference, которые увеличивают
+# номер поколения; остальные страницы берут списки из памяти.
+_REF_GEN = 0
+_REF_CACHE: Optional[Tuple[int, db.ReferenceLists]] = None
+
+
+def get_references() -> db.ReferenceLists:
+    global _REF_CACHE
+    if _REF_CACHE is None or _REF_CACHE[0] != _REF_GEN:
+        _REF_CACHE = (_REF_GEN, db.load_reference_lists())
+    return _REF_CACHE[1]
+
+
+def invalidate_references() -> None:
+    global _REF_GEN
+    _REF_GEN += 1
+
+
+# Номер поколения записей ДДС: увеличивается при каждом изменении cashflows.
+_CF_GEN = 0
+
+
+def invalidate_cashflows() -> None:
+    global _CF_GEN
+    _CF_GEN += 1
+    _render_index_body.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def _references_by_id(references: db.ReferenceLists) -> Dict[str, Dict[int, sqlite3.Row]]:
+    """Index reference lists by id; the cache holds the index for the current lists."""
+    return {
+        "statuses": {item["id"]: item for item in references.statuses},
+        "types": {item["id"]: item for item in references.types},
+        "categories": {item["id"]: item for item in references.categories},
+        "subcategories": {item["id"]: item for item in references.subcategories},
+    }
+
+
+@lru_cache(maxsize=1)
+def _filter_options(generation: int) -> Dict[str, str]:
+    """Build the filter <option> lists without a selection for one reference generation."""
+    references = get_references()
+
+    def options(items: List[sqlite3.Row]) -> str:
+        return "<option value=''>— все —</option>" + "".join(
+            f"<option value='{item['id']}'>{esc(item['name'])}</option>" for item in items
+        )
+
+    return {
+        "status_id": options(references.statuses),
+        "type_id": options(references.types),
+        "category_id": options(references.categories),
+        "subcategory_id": options(references.subcategories),
+    }
+
+
+def options_with_selection(base_html: str, selected: str) -> str:
+    if not selected:
+        return base_html
+    return base_html.replace(f"value='{selected}'>", f"value='{selected}' selected>", 1)
 
 
 # ----- Представления -----
 
 
-def format_reference_name(row: Dict[str, Any]) -> str:
-    name = html.escape(row["name"])
-    if "type_name" in row:
-        name += f"<span class='meta'>{html.escape(row['type_name'])}</span>"
-    elif "category_name" in row:
-        name += f"<span class='meta'>{html.escape(row['category_name'])}</span>"
+def format_reference_name(row: sqlite3.Row) -> str:
+    name = esc(row["name"])
+    # Строки всех справочников имеют одинаковые столбцы; лишние из них равны NULL.
+    if row["type_name"] is not None:
+        name += f"<span class='meta'>{esc(row['type_name'])}</span>"
+    elif row["category_name"] is not None:
+        name += f"<span class='meta'>{esc(row['category_name'])}</span>"
     return name
 
 
-def view_index(request: Request, params: Dict[str, str]) -> Response:
-    filters = {
-        "date_from": request.form_value("date_from"),
-        "date_to": request.form_value("date_to"),
-        "status_id": request.form_value("status_id"),
-        "type_id": request.form_value("type_id"),
-        "category_id": request.form_value("category_id"),
-        "subcategory_id": request.form_value("subcategory_id"),
-    }
+_ENTRY_ROW_TEMPLATE = (
+    "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td>"
+    "<td class='actions'>"
+    "<a class='btn secondary' href='/entries/%s/edit'>Изменить</a>"
+    "<form method='post' action='/entries/%s/delete' style='display:inline' onsubmit='return confirm(\"Удалить запись?\");'>"
+    "<button type='submit' class='btn danger'>Удалить</button></form></td></tr>"
+)
+
+
+_INDEX_DATE_FILTERS = ("date_from", "date_to")
+_INDEX_ID_FILTERS = ("status_id", "type_id", "category_id", "subcategory_id")
+
+
+def normalize_index_filters(request: Request) -> Tuple[Tuple[str, str], ...]:
+    """Return the listing filters as a cache key, dropping malformed values."""
+    # Некорректные значения отбрасываются: иначе произвольные строки размножали бы
+    # записи кэша с полной копией списка.
+    filters = []
+    for key in _INDEX_DATE_FILTERS:
+        value = request.form_value(key).strip()
+        filters.append((key, value if is_valid_date(value) else ""))
+    for key in _INDEX_ID_FILTERS:
+        number = parse_int(request.form_value(key).strip())
+        filters.append((key, str(number) if number and number > 0 else ""))
+    return tuple(filters)
+
+
+# Каждая запись хранит весь список без пагинации, поэтому кэш держится небольшим.
+@lru_cache(maxsize=8)
+def _render_index_body(filters_key: Tuple[Tuple[str, str], ...], cf_gen: int, ref_gen: int) -> bytes:
+    """Render and encode the listing page body for one filter set and data generation."""
+    filters = dict(filters_key)
     entries = repo.list_cashflows({k: v for k, v in filters.items() if v})
-    references = db.load_reference_lists()
-
-    rows_html = "".join(
-        f"<tr><td>{html.escape(entry['recorded_on'])}</td>"
-        f"<td>{html.escape(entry['status_name'])}</td>"
-        f"<td>{html.escape(entry['type_name'])}</td>"
-        f"<td>{html.escape(entry['category_name'])}</td>"
-        f"<td>{html.escape(entry['subcategory_name'])}</td>"
-        f"<td>{format_amount(entry['amount_cents'])}</td>"
-        f"<td>{html.escape(entry['comment'] or '')}</td>"
-        f"<td class='actions'>"
-        f"<a class='btn secondary' href='/entries/{entry['id']}/edit'>Изменить</a>"
-        f"<form method='post' action='/entries/{entry['id']}/delete' style='display:inline' onsubmit='return confirm(\"Удалить запись?\");'>"
-        f"<button type='submit' class='btn danger'>Удалить</button></form></td></tr>"
+
+    rows_html = "".join([
+        _ENTRY_ROW_TEMPLATE % (
+            esc(entry["recorded_on"]),
+            esc(entry["status_name"]),
+            esc(entry["type_name"]),
+            esc(entry["category_name"]),
+            esc(entry["subcategory_name"]),
+            format_amount(entry["amount_cents"]),
+            esc(entry["comment"] or ""),
+            entry["id"],
+            entry["id"],
+        )
         for entry in entries
-    )
+    ])
     if not rows_html:
         rows_html = "<tr><td colspan='8' style='text-align:center;color:#6b7280;'>Нет записей</td></tr>"
 
-    def options(items: List[Dict[str, Any]], selected: str) -> str:
-        opts = ["<option value=''>— все —</option>"]
-        for item in items:
-            sel = " selected" if str(item["id"]) == selected else ""
-            opts.append(f"<option value='{item['id']}'{sel}>{html.escape(item['name'])}</option>")
-        return "".join(opts)
+    base_options = _filter_options(ref_gen)
+
+    def options(key: str) -> str:
+        return options_with_selection(base_options[key], filters[key])
 
     filter_form = f"""
     <form method="get" class="grid two">
         <div>
             <label>Дата с
-                <input type="date" name="date_from" value="{html.escape(filters['date_from'])}">
+                <input type="date" name="date_from" value="{esc(filters['date_from'])}">
             </label>
         </div>
         <div>
             <label>Дата по
-                <input type="date" name="date_to" value="{html.escape(filters['date_to'])}">
+                <input type="date" name="date_to" value="{esc(filters['date_to'])}">
             </label>
         </div>
         <div>
             <label>Статус
-                <select name="status_id">{options(references.statuses, filters['status_id'])}</select>
+                <select name="status_id">{options('status_id')}</select>
             </label>
         </div>
         <div>
             <label>Тип
-                <select name="type_id">{options(references.types, filters['type_id'])}</select>
+                <select name="type_id">{options('type_id')}</select>
             </label>
         </div>
         <div>
             <label>Категория
-                <select name="category_id">{options(references.categories, filters['category_id'])}</select>
+                <select name="category_id">{options('category_id')}</select>
             </label>
         </div>
         <div>
             <label>Подкатегория
-                <select name="subcategory_id">{options(references.subcategories, filters['subcategory_id'])}</select>
+                <select name="subcategory_id">{options('subcategory_id')}</select>
             </label>
         </div>
         <div class="actions">
@@ -272,28 +504,50 @@ def view_index(request: Request, params: Dict[str, str]) -> Response:
         </thead>
         <tbody>
     """ + rows_html + "</tbody></table>"
+    return body.encode("utf-8")
+
+
+def view_index(request: Request, params: Dict[str, Any]) -> Response:
+    body = _render_index_body(normalize_index_filters(request), _CF_GEN, _REF_GEN)
 
     message = []
-    if request.query.get("success"):
-        message.append(("success", request.query["success"][0]))
-    return "200 OK", [("Content-Type", "text/html; charset=utf-8")], render_page("Список записей", body, messages=message, active="home")
+    success = request.GET.get("success")
+    if success:
+        message.append(("success", success))
+    return "200 OK", HTML_HEADERS, render_page("Список записей", body, messages=message, active="home")
+
+
+@lru_cache(maxsize=1)
+def _entry_form_mappings(
+    references: db.ReferenceLists,
+) -> Tuple[Dict[str, List[sqlite3.Row]], Dict[str, List[sqlite3.Row]], str]:
+    """Group categories and subcategories by parent and serialize them for the form script."""
+    # load_reference_lists отдаёт строки, сгруппированные по родителю, поэтому сортировка не нужна.
+    type_to_categories = {
+        str(type_id): list(group)
+        for type_id, group in groupby(references.categories, key=itemgetter("type_id"))
+    }
+    category_to_subcats = {
+        str(category_id): list(group)
+        for category_id, group in groupby(references.subcategories, key=itemgetter("category_id"))
+    }
 
+    script_data = {
+        "typeToCategories": type_to_categories,
+        "categoryToSubcategories": category_to_subcats,
+    }
+    return type_to_categories, category_to_subcats, json.dumps(script_data, cls=RowEncoder)
 
-def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> str:
-    type_to_categories: Dict[str, List[Dict[str, Any]]] = {}
-    for category in references.categories:
-        type_to_categories.setdefault(str(category["type_id"]), []).append(category)
 
-    category_to_subcats: Dict[str, List[Dict[str, Any]]] = {}
-    for sub in references.subcategories:
-        category_to_subcats.setdefault(str(sub["category_id"]), []).append(sub)
+def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> str:
+    type_to_categories, category_to_subcats, script_json = _entry_form_mappings(references)
 
     type_options = "".join(
-        f"<option value='{t['id']}' {'selected' if str(t['id']) == str(data.get('type_id','')) else ''}>{html.escape(t['name'])}</option>"
+        f"<option value='{t['id']}' {'selected' if str(t['id']) == str(data.get('type_id','')) else ''}>{esc(t['name'])}</option>"
         for t in references.types
     )
     status_options = "".join(
-        f"<option value='{s['id']}' {'selected' if str(s['id']) == str(data.get('status_id','')) else ''}>{html.escape(s['name'])}</option>"
+        f"<option value='{s['id']}' {'selected' if str(s['id']) == str(data.get('status_id','')) else ''}>{esc(s['name'])}</option>"
         for s in references.statuses
     )
 
@@ -302,9 +556,9 @@ def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> s
     selected_category = str(data.get("category_id", ""))
     selected_subcategory = str(data.get("subcategory_id", ""))
 
-    def build_options(items: List[Dict[str, Any]], selected_value: str) -> str:
+    def build_options(items: List[sqlite3.Row], selected_value: str) -> str:
         return "".join(
-            f"<option value='{item['id']}' {'selected' if str(item['id']) == selected_value else ''}>{html.escape(item['name'])}</option>"
+            f"<option value='{item['id']}' {'selected' if str(item['id']) == selected_value else ''}>{esc(item['name'])}</option>"
             for item in items
         )
 
@@ -313,16 +567,11 @@ def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> s
     subcategories_for_category = category_to_subcats.get(selected_category, []) if selected_category else []
     subcategory_options = build_options(subcategories_for_category, selected_subcategory)
 
-    script_data = {
-        "typeToCategories": type_to_categories,
-        "categoryToSubcategories": category_to_subcats,
-    }
-
     return f"""
     <form method="post" class="grid two" id="entry-form">
         <div>
             <label>Дата операции
-                <input type="date" name="recorded_on" value="{html.escape(str(data.get('recorded_on','')))}" required>
+                <input type="date" name="recorded_on" value="{esc(data.get('recorded_on',''))}" required>
             </label>
         </div>
         <div>
@@ -356,12 +605,12 @@ def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> s
         </div>
         <div>
             <label>Сумма, ₽
-                <input type="text" name="amount" value="{html.escape(str(data.get('amount','')))}" placeholder="например, 1000" required>
+                <input type="text" name="amount" value="{esc(data.get('amount',''))}" placeholder="например, 1000" required>
             </label>
         </div>
         <div style="grid-column: 1 / -1;">
             <label>Комментарий
-                <textarea name="comment" placeholder="Необязательное поле">{html.escape(str(data.get('comment','')))}</textarea>
+                <textarea name="comment" placeholder="Необязательное поле">{esc(data.get('comment',''))}</textarea>
             </label>
         </div>
         <div class="actions" style="grid-column: 1 / -1;">
@@ -370,7 +619,7 @@ def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> s
         </div>
     </form>
     <script>
-    const data = {json.dumps(script_data)};
+    const data = {script_json};
     const typeSelect = document.getElementById('type-select');
     const categorySelect = document.getElementById('category-select');
     const subcategorySelect = document.getElementById('subcategory-select');
@@ -420,57 +669,60 @@ def entry_form_context(references: db.ReferenceLists, data: Dict[str, Any]) -> s
     """
 
 
-def validate_entry_form(form: Dict[str, str]) -> Tuple[Dict[str, Any], List[str]]:
+def validate_entry_form(form: Dict[str, str], references: db.ReferenceLists) -> Tuple[Dict[str, Any], List[str]]:
     errors: List[str] = []
     data: Dict[str, Any] = {}
 
     recorded_on = form.get("recorded_on", "").strip()
     if not recorded_on:
         errors.append("Дата операции обязательна")
+    elif not is_valid_date(recorded_on):
+        errors.append("Введите корректную дату операции")
     else:
         data["recorded_on"] = recorded_on
 
+    # Проверка идёт по справочникам из кэша, без обращений к базе.
+    by_id = _references_by_id(references)
     status_id = parse_int(form.get("status_id", ""))
+    type_id = parse_int(form.get("type_id", ""))
+    category_id = parse_int(form.get("category_id", ""))
+    subcategory_id = parse_int(form.get("subcategory_id", ""))
+
     if not status_id:
         errors.append("Статус обязателен")
-    elif not repo.get_status(status_id):
+    elif status_id not in by_id["statuses"]:
         errors.append("Выбран несуществующий статус")
     else:
         data["status_id"] = status_id
 
-    type_id = parse_int(form.get("type_id", ""))
     if not type_id:
         errors.append("Тип обязателен")
-    elif not repo.get_type(type_id):
+    elif type_id not in by_id["types"]:
         errors.append("Выбран несуществующий тип")
     else:
         data["type_id"] = type_id
 
-    category_id = parse_int(form.get("category_id", ""))
+    category = by_id["categories"].get(category_id) if category_id else None
     if not category_id:
         errors.append("Категория обязательна")
+    elif category is None:
+        errors.append("Выбрана несуществующая категория")
     else:
-        category = repo.get_category(category_id)
-        if not category:
-            errors.append("Выбрана несуществующая категория")
-        else:
-            data["category_id"] = category_id
-            if type_id and category["type_id"] != type_id:
-                errors.append("Категория не связана с выбранным типом")
+        data["category_id"] = category_id
+        if type_id and category["type_id"] != type_id:
+            errors.append("Категория не связана с выбранным типом")
 
-    subcategory_id = parse_int(form.get("subcategory_id", ""))
+    subcategory = by_id["subcategories"].get(subcategory_id) if subcategory_id else None
     if not subcategory_id:
         errors.append("Подкатегория обязательна")
+    elif subcategory is None:
+        errors.append("Выбрана несуществующая подкатегория")
     else:
-        subcategory = repo.get_subcategory(subcategory_id)
-        if not subcategory:
-            errors.append("Выбрана несуществующая подкатегория")
-        else:
-            data["subcategory_id"] = subcategory_id
-            if category_id and subcategory["category_id"] != category_id:
-                errors.append("Подкатегория не относится к выбранной категории")
-            if type_id and subcategory["type_id"] != type_id:
-                errors.append("Подкатегория не относится к выбранному типу")
+        data["subcategory_id"] = subcategory_id
+        if category_id and subcategory["category_id"] != category_id:
+            errors.append("Подкатегория не относится к выбранной категории")
+        if type_id and subcategory["type_id"] != type_id:
+            errors.append("Подкатегория не относится к выбранному типу")
 
     amount_raw = form.get("amount", "")
     cents = parse_amount(amount_raw)
@@ -485,44 +737,50 @@ def validate_entry_form(form: Dict[str, str]) -> Tuple[Dict[str, Any], List[str]
     return data, errors
 
 
-def view_new_entry(request: Request, params: Dict[str, str]) -> Response:
-    references = db.load_reference_lists()
+@lru_cache(maxsize=1)
+def _new_entry_form(generation: int, today: str) -> bytes:
+    """Render and encode the empty entry form for one reference generation and calendar day."""
     defaults = {
-        "recorded_on": date.today().isoformat(),
+        "recorded_on": today,
         "amount": "",
     }
-    body = entry_form_context(references, defaults)
+    return entry_form_context(get_references(), defaults).encode("utf-8")
+
+
+def view_new_entry(request: Request, params: Dict[str, Any]) -> Response:
+    body = _new_entry_form(_REF_GEN, date.today().isoformat())
     return (
         "200 OK",
-        [("Content-Type", "text/html; charset=utf-8")],
+        HTML_HEADERS,
         render_page("Новая запись", body, active="create"),
     )
 
 
-def view_create_entry(request: Request, params: Dict[str, str]) -> Response:
+def view_create_entry(request: Request, params: Dict[str, Any]) -> Response:
     form = request.POST
-    data, errors = validate_entry_form(form)
-    references = db.load_reference_lists()
+    references = get_references()
+    data, errors = validate_entry_form(form, references)
     if errors:
         body = entry_form_context(references, {**form, **data})
         messages = [("error", error) for error in errors]
         return (
             "400 Bad Request",
-            [("Content-Type", "text/html; charset=utf-8")],
+            HTML_HEADERS,
             render_page("Новая запись", body, messages=messages, active="create"),
         )
 
     repo.create_cashflow(data)
+    invalidate_cashflows()
     query = urlencode({"success": "Запись успешно создана"})
     return redirect(f"/?{query}")
 
 
-def view_edit_entry(request: Request, params: Dict[str, str]) -> Response:
-    entry_id = int(params["entry_id"])
+def view_edit_entry(request: Request, params: Dict[str, Any]) -> Response:
+    entry_id = params["entry_id"]
     entry = repo.get_cashflow(entry_id)
     if not entry:
         return not_found()
-    references = db.load_reference_lists()
+    references = get_references()
     form_data = {
         "recorded_on": entry["recorded_on"],
         "status_id": entry["status_id"],
@@ -530,41 +788,49 @@ def view_edit_entry(request: Request, params: Dict[str, str]) -> Response:
         "category_id": entry["category_id"],
         "subcategory_id": entry["subcategory_id"],
         "amount": f"{entry['amount_cents'] / 100:.2f}",
-        "comment": entry.get("comment", ""),
+        "comment": entry["comment"] or "",
     }
     body = entry_form_context(references, form_data)
     return (
         "200 OK",
-        [("Content-Type", "text/html; charset=utf-8")],
+        HTML_HEADERS,
         render_page("Редактирование записи", body, active="create"),
     )
 
 
-def view_update_entry(request: Request, params: Dict[str, str]) -> Response:
-    entry_id = int(params["entry_id"])
-    if not repo.get_cashflow(entry_id):
-        return not_found()
+def view_update_entry(request: Request, params: Dict[str, Any]) -> Response:
+    entry_id = params["entry_id"]
     form = request.POST
-    data, errors = validate_entry_form(form)
-    references = db.load_reference_lists()
+    references = get_references()
+    data, errors = validate_entry_form(form, references)
     if errors:
+        # При ошибках записи нет, поэтому блокировка на запись не нужна.
+        if not repo.get_cashflow(entry_id):
+            return not_found()
         body = entry_form_context(references, {**form, **data})
         messages = [("error", error) for error in errors]
         return (
             "400 Bad Request",
-            [("Content-Type", "text/html; charset=utf-8")],
+            HTML_HEADERS,
             render_page("Редактирование записи", body, messages=messages, active="create"),
         )
-    repo.update_cashflow(entry_id, data)
+    # Проверка существования и изменение выполняются в одной транзакции.
+    with db.transaction():
+        if not repo.get_cashflow(entry_id):
+            return not_found()
+        repo.update_cashflow(entry_id, data)
+    invalidate_cashflows()
     query = urlencode({"success": "Запись обновлена"})
     return redirect(f"/?{query}")
 
 
-def view_delete_entry(request: Request, params: Dict[str, str]) -> Response:
-    entry_id = int(params["entry_id"])
-    if not repo.get_cashflow(entry_id):
-        return not_found()
-    repo.delete_cashflow(entry_id)
+def view_delete_entry(request: Request, params: Dict[str, Any]) -> Response:
+    entry_id = params["entry_id"]
+    with db.transaction():
+        if not repo.get_cashflow(entry_id):
+            return not_found()
+        repo.delete_cashflow(entry_id)
+    invalidate_cashflows()
     query = urlencode({"success": "Запись удалена"})
     return redirect(f"/?{query}")
 
@@ -572,29 +838,8 @@ def view_delete_entry(request: Request, params: Dict[str, str]) -> Response:
 # ----- Управление справочниками -----
 
 
-def render_reference_page(messages: Optional[List[Tuple[str, str]]] = None) -> Response:
-    references = db.load_reference_lists()
-
-    def render_table(title: str, rows: List[Dict[str, Any]], edit_url: str, delete_url: str, extra: str = "") -> str:
-        header = f"<h2>{html.escape(title)}</h2>"
-        table_rows = "".join(
-            f"<tr><td>{html.escape(str(row['id']))}</td><td>{format_reference_name(row)}</td>"
-            f"<td class='actions'><a class='btn secondary' href='{edit_url.format(row['id'])}'>Изменить</a>"
-            f"<form method='post' action='{delete_url.format(row['id'])}' style='display:inline' onsubmit='return confirm(\"Удалить элемент?\");'>"
-            f"<button type='submit' class='btn danger'>Удалить</button></form></td></tr>"
-            for row in rows
-        )
-        if not table_rows:
-            table_rows = "<tr><td colspan='3' style='text-align:center;color:#6b7280;'>Нет данных</td></tr>"
-        return header + extra + f"<table><thead><tr><th>ID</th><th>Название</th><th>Действия</th></tr></thead><tbody>{table_rows}</tbody></table>"
-
-    body_parts = [
-        render_table(
-            "Статусы",
-            references.statuses,
-            "/reference/statuses/{}/edit",
-            "/reference/statuses/{}/delete",
-            """
+# Формы добавления статуса и типа не зависят от данных и собираются один раз.
+_STATUS_FORM_EXTRA = """
             <form method='post' action='/reference/statuses'>
                 <label>Новый статус
                     <input type='text' name='name' required>
@@ -603,14 +848,9 @@ def render_reference_page(messages: Optional[List[Tuple[str, str]]] = None) -> R
                     <button class='btn' type='submit'>Добавить</button>
                 </div>
             </form>
-            """,
-        ),
-        render_table(
-            "Типы операций",
-            references.types,
-            "/reference/types/{}/edit",
-            "/reference/types/{}/delete",
             """
+
+_TYPE_FORM_EXTRA = """
             <form method='post' action='/reference/types'>
                 <label>Новый тип
                     <input type='text' name='name' required>
@@ -619,11 +859,9 @@ def render_reference_page(messages: Optional[List[Tuple[str, str]]] = None) -> R
                     <button class='btn' type='submit'>Добавить</button>
                 </div>
             </form>
-            """,
-        ),
-    ]
+            """
 
-    category_form = """
+_CATEGORY_FORM_TEMPLATE = """
         <form method='post' action='/reference/categories'>
             <label>Название категории
                 <input type='text' name='name' required>
@@ -638,26 +876,8 @@ def render_reference_page(messages: Optional[List[Tuple[str, str]]] = None) -> R
             </div>
         </form>
     """
-    type_options = "".join(
-        f"<option value='{t['id']}'>{html.escape(t['name'])}</option>" for t in references.types
-    )
-    category_form = category_form.format(type_options=type_options)
-
-    body_parts.append(
-        render_table(
-            "Категории",
-            references.categories,
-            "/reference/categories/{}/edit",
-            "/reference/categories/{}/delete",
-            category_form,
-        )
-    )
 
-    category_options_for_sub = "".join(
-        f"<option value='{c['id']}'>{html.escape(c['name'])} ({html.escape(c['type_name'])})</option>"
-        for c in references.categories
-    )
-    subcategory_form = """
+_SUBCATEGORY_FORM_TEMPLATE = """
         <form method='post' action='/reference/subcategories'>
             <label>Название подкатегории
                 <input type='text' name='name' required>
@@ -671,82 +891,215 @@ def render_reference_page(messages: Optional[List[Tuple[str, str]]] = None) -> R
                 <button class='btn' type='submit'>Добавить</button>
             </div>
         </form>
-    """.format(category_options=category_options_for_sub)
+    """
+
+
+@lru_cache(maxsize=1)
+def _reference_create_forms(generation: int) -> Tuple[str, str]:
+    """Build the category and subcategory creation forms for one reference generation."""
+    references = get_references()
+    type_options = "".join(
+        f"<option value='{t['id']}'>{esc(t['name'])}</option>" for t in references.types
+    )
+    category_options = "".join(
+        f"<option value='{c['id']}'>{esc(c['name'])} ({esc(c['type_name'])})</option>"
+        for c in references.categories
+    )
+    return (
+        _CATEGORY_FORM_TEMPLATE.format(type_options=type_options),
+        _SUBCATEGORY_FORM_TEMPLATE.format(category_options=category_options),
+    )
+
 
-    body_parts.append(
+@lru_cache(maxsize=1)
+def _build_reference_body(generation: int) -> bytes:
+    """Render the encoded reference page body for one reference generation."""
+    references = get_references()
+    category_form, subcategory_form = _reference_create_forms(generation)
+
+    def render_table(title: str, rows: List[sqlite3.Row], edit_url: str, delete_url: str, extra: str = "") -> str:
+        header = f"<h2>{esc(title)}</h2>"
+        table_rows = "".join(
+            f"<tr><td>{row['id']}</td><td>{format_reference_name(row)}</td>"
+            f"<td class='actions'><a class='btn secondary' href='{edit_url.format(row['id'])}'>Изменить</a>"
+            f"<form method='post' action='{delete_url.format(row['id'])}' style='display:inline' onsubmit='return confirm(\"Удалить элемент?\");'>"
+            f"<button type='submit' class='btn danger'>Удалить</button></form></td></tr>"
+            for row in rows
+        )
+        if not table_rows:
+            table_rows = "<tr><td colspan='3' style='text-align:center;color:#6b7280;'>Нет данных</td></tr>"
+        return header + extra + f"<table><thead><tr><th>ID</th><th>Название</th><th>Действия</th></tr></thead><tbody>{table_rows}</tbody></table>"
+
+    body_parts = [
+        render_table(
+            "Статусы",
+            references.statuses,
+            "/reference/statuses/{}/edit",
+            "/reference/statuses/{}/delete",
+            _STATUS_FORM_EXTRA,
+        ),
+        render_table(
+            "Типы операций",
+            references.types,
+            "/reference/types/{}/edit",
+            "/reference/types/{}/delete",
+            _TYPE_FORM_EXTRA,
+        ),
+        render_table(
+            "Категории",
+            references.categories,
+            "/reference/categories/{}/edit",
+            "/reference/categories/{}/delete",
+            category_form,
+        ),
         render_table(
             "Подкатегории",
             references.subcategories,
             "/reference/subcategories/{}/edit",
             "/reference/subcategories/{}/delete",
             subcategory_form,
-        )
-    )
+        ),
+    ]
+
+    return ("<div class='grid'>" + "".join(body_parts) + "</div>").encode("utf-8")
 
-    body = "<div class='grid'>" + "".join(body_parts) + "</div>"
+
+def render_reference_page(messages: Optional[List[Tuple[str, str]]] = None) -> Response:
+    # Таблицы справочников не зависят от сообщений и берутся из кэша.
+    body = _build_reference_body(_REF_GEN)
     return (
         "200 OK",
-        [("Content-Type", "text/html; charset=utf-8")],
+        HTML_HEADERS,
         render_page("Справочники", body, messages=messages, active="reference"),
     )
 
 
+# Страница 404 одинакова для всех запросов и рендерится один раз при импорте.
+_NOT_FOUND_BODY = tuple(render_page("Страница не найдена", "<p>Запрошенный ресурс не найден.</p>"))
+
+
 def not_found() -> Response:
-    body = render_page("Страница не найдена", "<p>Запрошенный ресурс не найден.</p>")
-    return "404 Not Found", [("Content-Type", "text/html; charset=utf-8")], body
+    return "404 Not Found", HTML_HEADERS, _NOT_FOUND_BODY
 
 
-def view_reference(request: Request, params: Dict[str, str]) -> Response:
+def view_reference(request: Request, params: Dict[str, Any]) -> Response:
     return render_reference_page()
 
 
-def handle_reference_creation(entity: str, request: Request, params: Dict[str, str]) -> Response:
+@dataclass(frozen=True)
+class ReferenceOp:
+    """Repository functions and messages for one kind of reference entity."""
+
+    get: Callable[[int], Optional[sqlite3.Row]]
+    create: Callable[..., int]
+    update: Callable[..., Optional[int]]
+    delete: Callable[[int], None]
+    # Связи, при наличии которых элемент нельзя удалить.
+    delete_deps: Tuple[Tuple[str, str], ...]
+    delete_error: str
+    # Для категорий и подкатегорий: поле родителя в форме и строке, его поиск,
+    # связь, запрещающая смену родителя, и тексты ошибок.
+    parent_field: Optional[str] = None
+    get_parent: Optional[Callable[[int], Optional[sqlite3.Row]]] = None
+    parent_table: str = ""
+    parent_error: str = ""
+    # Столбец элемента в cashflows: записи ДДС запрещают смену родителя.
+    cashflow_column: str = ""
+    parent_change_error: str = ""
+
+
+REFERENCE_OPS: Dict[str, ReferenceOp] = {
+    "status": ReferenceOp(
+        get=repo.get_status,
+        create=repo.create_status,
+        update=repo.update_status,
+        delete=repo.delete_status,
+        delete_deps=(("cashflows", "status_id"),),
+        delete_error="Нельзя удалить статус, пока существуют связанные записи ДДС",
+    ),
+    "type": ReferenceOp(
+        get=repo.get_type,
+        create=repo.create_type,
+        update=repo.update_type,
+        delete=repo.delete_type,
+        delete_deps=(("categories", "type_id"), ("cashflows", "type_id")),
+        delete_error="Нельзя удалить тип с существующими категориями или записями ДДС",
+    ),
+    "category": ReferenceOp(
+        get=repo.get_category,
+        create=repo.create_category,
+        update=repo.update_category,
+        delete=repo.delete_category,
+        delete_deps=(("subcategories", "category_id"), ("cashflows", "category_id")),
+        delete_error="Нельзя удалить категорию, пока существуют связанные подкатегории или записи ДДС",
+        parent_field="type_id",
+        get_parent=repo.get_type,
+        parent_table="types",
+        parent_error="Выберите корректный тип",
+        cashflow_column="category_id",
+        parent_change_error="Нельзя изменить тип категории, пока существуют связанные записи ДДС",
+    ),
+    "subcategory": ReferenceOp(
+        get=repo.get_subcategory,
+        create=repo.create_subcategory,
+        update=repo.update_subcategory,
+        delete=repo.delete_subcategory,
+        delete_deps=(("cashflows", "subcategory_id"),),
+        delete_error="Нельзя удалить подкатегорию, пока существуют связанные записи ДДС",
+        parent_field="category_id",
+        get_parent=repo.get_category,
+        parent_table="categories",
+        parent_error="Выберите корректную категорию",
+        cashflow_column="subcategory_id",
+        parent_change_error="Нельзя изменить категорию подкатегории, пока существуют связанные записи ДДС",
+    ),
+}
+
+
+def parse_reference_parent(op: ReferenceOp, request: Request) -> Optional[int]:
+    """Return the submitted parent id if it refers to an existing row."""
+    assert op.parent_field is not None and op.get_parent is not None
+    parent_id = parse_int(request.POST.get(op.parent_field, ""))
+    if not parent_id or not op.get_parent(parent_id):
+        return None
+    return parent_id
+
+
+def handle_reference_creation(entity: str, request: Request, params: Dict[str, Any]) -> Response:
     name = request.POST.get("name", "").strip()
     if not name:
         return render_reference_page([("error", "Название обязательно")])
+    op = REFERENCE_OPS[entity]
     try:
-        if entity == "status":
-            repo.create_status(name)
-        elif entity == "type":
-            repo.create_type(name)
-        elif entity == "category":
-            type_id = parse_int(request.POST.get("type_id", ""))
-            if not type_id or not repo.get_type(type_id):
-                return render_reference_page([("error", "Выберите корректный тип")])
-            repo.create_category(name, type_id)
-        elif entity == "subcategory":
-            category_id = parse_int(request.POST.get("category_id", ""))
-            if not category_id or not repo.get_category(category_id):
-                return render_reference_page([("error", "Выберите корректную категорию")])
-            repo.create_subcategory(name, category_id)
+        if op.parent_field is None:
+            op.create(name)
+        else:
+            parent_id = parse_reference_parent(op, request)
+            if parent_id is None:
+                return render_reference_page([("error", op.parent_error)])
+            op.create(name, parent_id)
     except sqlite3.IntegrityError:
         return render_reference_page([("error", "Элемент с таким названием уже существует")])
+    invalidate_references()
     return render_reference_page([("success", "Элемент добавлен")])
 
 
-def handle_reference_edit_form(entity: str, request: Request, params: Dict[str, str]) -> Response:
-    entity_id = int(params["entity_id"])
-    references = db.load_reference_lists()
-    if entity == "status":
-        item = repo.get_status(entity_id)
-    elif entity == "type":
-        item = repo.get_type(entity_id)
-    elif entity == "category":
-        item = repo.get_category(entity_id)
-    else:
-        item = repo.get_subcategory(entity_id)
+def handle_reference_edit_form(entity: str, request: Request, params: Dict[str, Any]) -> Response:
+    entity_id = params["entity_id"]
+    references = get_references()
+    item = REFERENCE_OPS[entity].get(entity_id)
     if not item:
         return not_found()
 
     if entity == "category":
         type_options = "".join(
-            f"<option value='{t['id']}' {'selected' if t['id'] == item['type_id'] else ''}>{html.escape(t['name'])}</option>"
+            f"<option value='{t['id']}' {'selected' if t['id'] == item['type_id'] else ''}>{esc(t['name'])}</option>"
             for t in references.types
         )
         extra = f"""
         <form method='post'>
             <label>Название
-                <input type='text' name='name' value='{html.escape(item['name'])}' required>
+                <input type='text' name='name' value='{esc(item['name'])}' required>
             </label>
             <label>Тип
                 <select name='type_id' required>{type_options}</select>
@@ -759,13 +1112,13 @@ def handle_reference_edit_form(entity: str, request: Request, params: Dict[str,
         """
     elif entity == "subcategory":
         category_options = "".join(
-            f"<option value='{c['id']}' {'selected' if c['id'] == item['category_id'] else ''}>{html.escape(c['name'])}</option>"
+            f"<option value='{c['id']}' {'selected' if c['id'] == item['category_id'] else ''}>{esc(c['name'])}</option>"
             for c in references.categories
         )
         extra = f"""
         <form method='post'>
             <label>Название
-                <input type='text' name='name' value='{html.escape(item['name'])}' required>
+                <input type='text' name='name' value='{esc(item['name'])}' required>
             </label>
             <label>Категория
                 <select name='category_id' required>{category_options}</select>
@@ -780,7 +1133,7 @@ def handle_reference_edit_form(entity: str, request: Request, params: Dict[str,
         extra = f"""
         <form method='post'>
             <label>Название
-                <input type='text' name='name' value='{html.escape(item['name'])}' required>
+                <input type='text' name='name' value='{esc(item['name'])}' required>
             </label>
             <div class='actions'>
                 <button class='btn' type='submit'>Сохранить</button>
@@ -792,75 +1145,61 @@ def handle_reference_edit_form(entity: str, request: Request, params: Dict[str,
     body = f"<h2>Редактирование</h2>{extra}"
     return (
         "200 OK",
-        [("Content-Type", "text/html; charset=utf-8")],
+        HTML_HEADERS,
         render_page("Редактирование", body, active="reference"),
     )
 
 
-def handle_reference_update(entity: str, request: Request, params: Dict[str, str]) -> Response:
-    entity_id = int(params["entity_id"])
+def handle_reference_update(entity: str, request: Request, params: Dict[str, Any]) -> Response:
+    entity_id = params["entity_id"]
     name = request.POST.get("name", "").strip()
     if not name:
         return render_reference_page([("error", "Название обязательно")])
 
+    op = REFERENCE_OPS[entity]
     try:
-        if entity == "status":
-            if not repo.get_status(entity_id):
+        # UPDATE ... RETURNING сообщает об отсутствии элемента без отдельного SELECT.
+        if op.parent_field is None:
+            if op.update(entity_id, name) is None:
                 return not_found()
-            repo.update_status(entity_id, name)
-        elif entity == "type":
-            if not repo.get_type(entity_id):
-                return not_found()
-            repo.update_type(entity_id, name)
-        elif entity == "category":
-            category = repo.get_category(entity_id)
-            if not category:
-                return not_found()
-            type_id = parse_int(request.POST.get("type_id", ""))
-            if not type_id or not repo.get_type(type_id):
-                return render_reference_page([("error", "Выберите корректный тип")])
-            if type_id != category["type_id"]:
-                # проверяем отсутствие записей ДДС для категории перед сменой типа
-                if repo.count_dependencies("cashflows", "category_id", entity_id) > 0:
-                    return render_reference_page([("error", "Нельзя изменить тип категории, пока существуют связанные записи ДДС")])
-            repo.update_category(entity_id, name, type_id)
         else:
-            subcategory = repo.get_subcategory(entity_id)
-            if not subcategory:
+            parent_id = parse_int(request.POST.get(op.parent_field, ""))
+            if not parent_id:
+                return render_reference_page([("error", op.parent_error)])
+            # Существование родителя и связанные записи ДДС проверяются одним запросом;
+            # смена родителя допустима только при отсутствии таких записей. Проверка и
+            # изменение идут в одной транзакции, страница рендерится после COMMIT.
+            updated = False
+            with db.transaction():
+                parent_exists, blocked = repo.check_reparent(
+                    op.parent_table, op.cashflow_column, op.parent_field, entity_id, parent_id
+                )
+                if parent_exists and not blocked:
+                    updated = op.update(entity_id, name, parent_id) is not None
+            if not parent_exists:
+                return render_reference_page([("error", op.parent_error)])
+            if blocked:
+                return render_reference_page([("error", op.parent_change_error)])
+            if not updated:
                 return not_found()
-            category_id = parse_int(request.POST.get("category_id", ""))
-            if not category_id:
-                return render_reference_page([("error", "Выберите корректную категорию")])
-            category = repo.get_category(category_id)
-            if not category:
-                return render_reference_page([("error", "Выберите корректную категорию")])
-            if repo.count_dependencies("cashflows", "subcategory_id", entity_id) > 0 and category_id != subcategory["category_id"]:
-                return render_reference_page([("error", "Нельзя изменить категорию подкатегории, пока существуют связанные записи ДДС")])
-            repo.update_subcategory(entity_id, name, category_id)
     except sqlite3.IntegrityError:
         return render_reference_page([("error", "Элемент с таким названием уже существует")])
 
+    invalidate_references()
     return render_reference_page([("success", "Изменения сохранены")])
 
 
-def handle_reference_delete(entity: str, request: Request, params: Dict[str, str]) -> Response:
-    entity_id = int(params["entity_id"])
-    if entity == "status":
-        if repo.count_dependencies("cashflows", "status_id", entity_id) > 0:
-            return render_reference_page([("error", "Нельзя удалить статус, пока существуют связанные записи ДДС")])
-        repo.delete_status(entity_id)
-    elif entity == "type":
-        if repo.count_dependencies("categories", "type_id", entity_id) > 0 or repo.count_dependencies("cashflows", "type_id", entity_id) > 0:
-            return render_reference_page([("error", "Нельзя удалить тип с существующими категориями или записями ДДС")])
-        repo.delete_type(entity_id)
-    elif entity == "category":
-        if repo.count_dependencies("subcategories", "category_id", entity_id) > 0 or repo.count_dependencies("cashflows", "category_id", entity_id) > 0:
-            return render_reference_page([("error", "Нельзя удалить категорию, пока существуют связанные подкатегории или записи ДДС")])
-        repo.delete_category(entity_id)
-    else:
-        if repo.count_dependencies("cashflows", "subcategory_id", entity_id) > 0:
-            return render_reference_page([("error", "Нельзя удалить подкатегорию, пока существуют связанные записи ДДС")])
-        repo.delete_subcategory(entity_id)
+def handle_reference_delete(entity: str, request: Request, params: Dict[str, Any]) -> Response:
+    entity_id = params["entity_id"]
+    op = REFERENCE_OPS[entity]
+    # Проверка связей и удаление выполняются в одной транзакции.
+    with db.transaction():
+        blocked = repo.has_dependencies_multi([(table, column, entity_id) for table, column in op.delete_deps])
+        if not blocked:
+            op.delete(entity_id)
+    if blocked:
+        return render_reference_page([("error", op.delete_error)])
+    invalidate_references()
     return render_reference_page([("success", "Элемент удалён")])
 
 
@@ -874,42 +1213,54 @@ router.add("POST", r"/entries/(?P<entry_id>\d+)/edit", view_update_entry)
 router.add("POST", r"/entries/(?P<entry_id>\d+)/delete", view_delete_entry)
 
 router.add("GET", r"/reference", view_reference)
-router.add("POST", r"/reference/statuses", lambda req, params: handle_reference_creation("status", req, params))
-router.add("POST", r"/reference/types", lambda req, params: handle_reference_creation("type", req, params))
-router.add("POST", r"/reference/categories", lambda req, params: handle_reference_creation("category", req, params))
-router.add("POST", r"/reference/subcategories", lambda req, params: handle_reference_creation("subcategory", req, params))
+router.add("POST", r"/reference/statuses", partial(handle_reference_creation, "status"))
+router.add("POST", r"/reference/types", partial(handle_reference_creation, "type"))
+router.add("POST", r"/reference/categories", partial(handle_reference_creation, "category"))
+router.add("POST", r"/reference/subcategories", partial(handle_reference_creation, "subcategory"))
 
-router.add("GET", r"/reference/statuses/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_edit_form("status", req, params))
-router.add("GET", r"/reference/types/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_edit_form("type", req, params))
-router.add("GET", r"/reference/categories/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_edit_form("category", req, params))
-router.add("GET", r"/reference/subcategories/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_edit_form("subcategory", req, params))
+router.add("GET", r"/reference/statuses/(?P<entity_id>\d+)/edit", partial(handle_reference_edit_form, "status"))
+router.add("GET", r"/reference/types/(?P<entity_id>\d+)/edit", partial(handle_reference_edit_form, "type"))
+router.add("GET", r"/reference/categories/(?P<entity_id>\d+)/edit", partial(handle_reference_edit_form, "category"))
+router.add("GET", r"/reference/subcategories/(?P<entity_id>\d+)/edit", partial(handle_reference_edit_form, "subcategory"))
 
-router.add("POST", r"/reference/statuses/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_update("status", req, params))
-router.add("POST", r"/reference/types/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_update("type", req, params))
-router.add("POST", r"/reference/categories/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_update("category", req, params))
-router.add("POST", r"/reference/subcategories/(?P<entity_id>\d+)/edit", lambda req, params: handle_reference_update("subcategory", req, params))
+router.add("POST", r"/reference/statuses/(?P<entity_id>\d+)/edit", partial(handle_reference_update, "status"))
+router.add("POST", r"/reference/types/(?P<entity_id>\d+)/edit", partial(handle_reference_update, "type"))
+router.add("POST", r"/reference/categories/(?P<entity_id>\d+)/edit", partial(handle_reference_update, "category"))
+router.add("POST", r"/reference/subcategories/(?P<entity_id>\d+)/edit", partial(handle_reference_update, "subcategory"))
 
-router.add("POST", r"/reference/statuses/(?P<entity_id>\d+)/delete", lambda req, params: handle_reference_delete("status", req, params))
-router.add("POST", r"/reference/types/(?P<entity_id>\d+)/delete", lambda req, params: handle_reference_delete("type", req, params))
-router.add("POST", r"/reference/categories/(?P<entity_id>\d+)/delete", lambda req, params: handle_reference_delete("category", req, params))
-router.add("POST", r"/reference/subcategories/(?P<entity_id>\d+)/delete", lambda req, params: handle_reference_delete("subcategory", req, params))
+router.add("POST", r"/reference/statuses/(?P<entity_id>\d+)/delete", partial(handle_reference_delete, "status"))
+router.add("POST", r"/reference/types/(?P<entity_id>\d+)/delete", partial(handle_reference_delete, "type"))
+router.add("POST", r"/reference/categories/(?P<entity_id>\d+)/delete", partial(handle_reference_delete, "category"))
+router.add("POST", r"/reference/subcategories/(?P<entity_id>\d+)/delete", partial(handle_reference_delete, "subcategory"))
 
 
 # ----- Точка входа WSGI -----
 
+# Страница ошибки рендерится заранее с меткой на месте текста исключения;
+# при ошибке остаётся подставить только экранированный текст.
+_ERROR_HEAD, _ERROR_TAIL = b"".join(
+    render_page("Ошибка", "<p>Произошла ошибка: \0</p>", messages=[("error", "Внутренняя ошибка сервера")])
+).split(b"\0")
+
+
 def application(environ: Dict[str, Any], start_response: Callable[[str, List[Tuple[str, str]]], None]):
     try:
         request = Request(environ)
         handler, params = router.resolve(request.method, request.path)
-        status, headers, body = handler(request, params)
-    except KeyError:
-        status, headers, body = not_found()
+        # Промах маршрута — обычный результат, а не исключение: 404 отдаётся без
+        # раскрутки стека, а KeyError из обработчиков больше не маскируется под 404.
+        if handler is None:
+            status, headers, body = not_found()
+        else:
+            status, headers, body = handler(request, params)
     except Exception as exc:  # pragma: no cover - защитный код
-        body = render_page("Ошибка", f"<p>Произошла ошибка: {html.escape(str(exc))}</p>", messages=[("error", "Внутренняя ошибка сервера")])
+        body = [_ERROR_HEAD, esc(exc).encode("utf-8"), _ERROR_TAIL]
         status = "500 Internal Server Error"
-        headers = [("Content-Type", "text/html; charset=utf-8")]
-    start_response(status, headers)
-    return [body]
+        headers = HTML_HEADERS
+    # Длина передаётся явно и для тела из нескольких фрагментов, которые не склеиваются
+    # ради подсчёта: wsgiref сам выставляет её только для тела из одного фрагмента.
+    start_response(status, [*headers, ("Content-Length", str(sum(map(len, body))))])
+    return body
 
 
 __all__ = ["application"]
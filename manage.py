@@ -3,15 +3,67 @@
 from __future__ import annotations
 
 import argparse
-from wsgiref.simple_server import make_server
+import queue
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, make_server
 
 from dds_app import db
 from dds_app.server import application
 
 
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server that handles requests on a fixed pool of reused worker threads."""
+
+    max_workers = 8
+    # Сколько секунд server_close ждёт, пока свободные потоки закроют свои соединения.
+    shutdown_timeout = 1.0
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._requests: queue.SimpleQueue = queue.SimpleQueue()
+        # Потоки пула живут всё время работы сервера, поэтому их соединения SQLite
+        # (threading.local в db) и кэш подготовленных выражений переиспользуются.
+        # Потоки-демоны не задерживают выход, даже если клиент держит пустое соединение.
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"dds-worker-{index}", daemon=True)
+            for index in range(self.max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def process_request(self, request, client_address) -> None:
+        self._requests.put((request, client_address))
+
+    def _worker(self) -> None:
+        while True:
+            item = self._requests.get()
+            if item is None:
+                # Соединения SQLite закрываются только в потоке, который их открыл;
+                # при закрытии выполняется PRAGMA optimize по запросам этого потока.
+                db.close_connection()
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+        # Поток, занятый простаивающим клиентом, не ждём: он демон и не мешает выходу.
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+
 def runserver(host: str, port: int) -> None:
     db.ensure_database()
-    with make_server(host, port, application) as httpd:
+    with make_server(host, port, application, server_class=ThreadPoolWSGIServer) as httpd:
         print(f"Сервер запущен на http://{host}:{port}")
         try:
             httpd.serve_forever()